@@ -7,14 +7,23 @@
 #               ▸ 週次増分グラフ & 累計グラフを docs/ に出力
 #               ▸ docs/index.html を更新（GitHub Pages 用）
 # -------------------------------------------------------------------
-import os, re, io, datetime, requests, pdfplumber, pandas as pd
+import os, re, io, json, shutil, hashlib, tempfile, datetime, requests, pandas as pd
+import pypdfium2 as pdfium
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")   # CI 上で GUI バックエンドを探さない（pyplot より先に指定）
 import matplotlib.pyplot as plt
-from bs4 import BeautifulSoup
-from dateutil import parser as dparser
+from requests.adapters import HTTPAdapter
+from lxml import html as lxml_html
+from pdfminer.converter import TextConverter
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
 
 # ------------- パス設定 ------------------------------------------------------
 ROOT        = os.path.dirname(os.path.dirname(__file__))
 DATA_CSV    = os.path.join(ROOT, "data", "fatalities.csv")
+CACHE_DIR   = os.path.join(ROOT, "data", ".cache")
+STATE_JSON  = os.path.join(ROOT, "data", ".state.json")
 DOCS_DIR    = os.path.join(ROOT, "docs")
 PNG_WEEKLY  = os.path.join(DOCS_DIR, "fatalities_weekly.png")
 PNG_CUM     = os.path.join(DOCS_DIR, "fatalities_cum.png")
@@ -24,19 +33,51 @@ LIST_URL    = "https://www.ochaopt.org/publications/snapshots"
 BASE_URL    = "https://www.ochaopt.org"
 
 os.makedirs(os.path.dirname(DATA_CSV), exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
 os.makedirs(DOCS_DIR, exist_ok=True)
 
+# ------------- HTTP セッション（keep-alive で接続を使い回す） ------------------
+SESSION = requests.Session()
+SESSION.headers["Accept-Encoding"] = "gzip, deflate"
+SESSION.headers["User-Agent"]      = "ocha-scrape/1.0"
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# ------------- 正規表現（モジュール読込時に一度だけコンパイル） ---------------
+NBSP = "\u00A0"   # 不換改行スペース
+_SNAPSHOT_RE = re.compile(r"Reported impact snapshot \| Gaza Strip \((\d{1,2} \w+ \d{4})\)")
+# 所有量指定子（Python 3.11+）でバックトラックを禁止し、OCR 崩れのテキストでも線形時間で照合
+_PAL_FATAL_RE = re.compile(
+    rf"Palestinians[^\d{NBSP}]{{0,40}}+([\d,{NBSP}\s]++)[^\w]{{0,20}}+fatalities",
+    re.I | re.S,
+)
+_NONDIGIT_RE = re.compile(r"[^\d]")
+
 # ------------- 1) 最新スナップショットの HTML ページ -------------------------
+def _parse_snapshot_date(s: str) -> datetime.date:
+    """「7 May 2025」形式の日付を strptime で解釈（dateutil の汎用パーサは使わない）"""
+    day, month, year = s.split()
+    try:
+        return datetime.datetime.strptime(f"{day} {month} {year}", "%d %B %Y").date()
+    except ValueError:   # "7 Sep 2025" / "7 Sept 2025" のような略記
+        return datetime.datetime.strptime(f"{day} {month[:3]} {year}", "%d %b %Y").date()
+
 def find_latest_snapshot_page() -> tuple[datetime.date, str]:
     """一覧ページを解析し、最も新しい snapshot の (日付, HTML URL) を返す"""
-    soup = BeautifulSoup(requests.get(LIST_URL, timeout=30).text, "lxml")
+    doc = lxml_html.fromstring(SESSION.get(LIST_URL, timeout=30).content)
     snaps = []
-    for a in soup.find_all("a", href=True):
-        t = a.get_text(strip=True)
-        m = re.match(r"Reported impact snapshot \| Gaza Strip \((\d{1,2} \w+ \d{4})\)", t)
+    # 絞り込みは libxml2 の XPath に任せ、正規表現は候補のみに適用
+    # （_SNAPSHOT_RE は先頭一致なので、前方一致の starts-with で十分）
+    for a in doc.xpath("//a[@href and starts-with(normalize-space(.), 'Reported impact snapshot')]"):
+        t = " ".join(a.text_content().split())
+        m = _SNAPSHOT_RE.match(t)
         if m:
-            d = dparser.parse(m.group(1), dayfirst=True).date()
-            url = a["href"]
+            try:
+                d = _parse_snapshot_date(m.group(1))
+            except ValueError:   # 解釈できない日付のリンクは無視する
+                continue
+            url = a.get("href")
             if not url.startswith("http"):
                 url = BASE_URL + url
             snaps.append((d, url))
@@ -47,66 +88,169 @@ def find_latest_snapshot_page() -> tuple[datetime.date, str]:
 
 # ------------- 2) HTML → PDF ダウンロードリンクを解決 ------------------------
 def resolve_pdf_url(page_url: str) -> str:
-    soup = BeautifulSoup(requests.get(page_url, timeout=30).text, "lxml")
-    for a in soup.find_all("a", href=True):
-        href = a["href"]
-        if href.lower().endswith(".pdf"):
-            return href if href.startswith("http") else BASE_URL + href
+    doc = lxml_html.fromstring(SESSION.get(page_url, timeout=30).content)
+    hrefs = doc.xpath(
+        "//a/@href[substring(translate(., 'PDF', 'pdf'), string-length(.) - 3) = '.pdf']"
+    )
+    if hrefs:
+        href = hrefs[0]
+        return href if href.startswith("http") else BASE_URL + href
     raise ValueError("PDF link not found in snapshot page")
 
 # ------------- 3) PDF から死亡者数を抽出 --------------------------------------
-NBSP = "\u00A0"   # 不換改行スペース
+def _write_json_atomic(path: str, obj, **kwargs):
+    # 途中で落ちても壊れないよう、一時ファイルに書いてから置き換える
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".json",
+                                     delete=False, encoding="utf-8") as tmp:
+        try:
+            json.dump(obj, tmp, **kwargs)
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    os.replace(tmp.name, path)
+
+def download_pdf(pdf_url: str) -> str:
+    """PDF を data/.cache/ にストリーム保存し、そのパスを返す
+
+    キャッシュ済みなら ETag / Last-Modified で再検証し、304 ならダウンロードしない。
+    """
+    key        = hashlib.sha1(pdf_url.encode("utf-8")).hexdigest()
+    pdf_path   = os.path.join(CACHE_DIR, key + ".pdf")
+    meta_path  = os.path.join(CACHE_DIR, key + ".json")
+
+    headers = {}
+    if os.path.exists(pdf_path) and os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with SESSION.get(pdf_url, headers=headers, timeout=60, stream=True) as r:
+        if r.status_code == 304:
+            return pdf_path
+        r.raise_for_status()
+        if not r.headers.get("content-type", "").lower().startswith("application/pdf"):
+            raise ValueError("resolved URL is not a PDF")
+        r.raw.decode_content = True   # Content-Encoding: gzip 等を展開して書き出す
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, delete=False, suffix=".pdf") as tmp:
+            try:
+                shutil.copyfileobj(r.raw, tmp, length=64 * 1024)
+            except BaseException:
+                # 途中で失敗したら書きかけの一時ファイルを残さない
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+        os.replace(tmp.name, pdf_path)
+        _write_json_atomic(meta_path, {"url": pdf_url,
+                                       "etag": r.headers.get("ETag"),
+                                       "last_modified": r.headers.get("Last-Modified")})
+    return pdf_path
+
+def _page_texts_pdfium(pdf_path: str):
+    """PDFium（C++）でページごとのテキストを返す。レイアウト解析を行わないので高速"""
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for page in pdf:
+            yield page.get_textpage().get_text_bounded()
+    finally:
+        pdf.close()
+
+def _page_texts_pdfminer(pdf_path: str):
+    """pdfminer の低レベル API でページごとの生テキストを返す
+
+    laparams=None でレイアウト解析（文字のクラスタリング）を行わないため pdfplumber より速い。
+    """
+    rsrcmgr = PDFResourceManager()
+    out     = io.StringIO()
+    with open(pdf_path, "rb") as f, TextConverter(rsrcmgr, out, laparams=None) as device:
+        interp = PDFPageInterpreter(rsrcmgr, device)
+        for page in PDFPage.get_pages(f):
+            out.seek(0)
+            out.truncate()
+            interp.process_page(page)
+            yield out.getvalue()
+
+def _find_deaths(page_texts) -> int | None:
+    # snapshot は通常 1 ページ。該当ページが見つかった時点で残りは解析しない
+    for text in page_texts:
+        m = _PAL_FATAL_RE.search(text)
+        if m:
+            return int(_NONDIGIT_RE.sub("", m.group(1)))
+    return None
+
 def extract_deaths(pdf_url: str) -> int:
-    r = requests.get(pdf_url, timeout=60)
-    r.raise_for_status()
-    if not r.headers.get("content-type", "").lower().startswith("application/pdf"):
-        raise ValueError("resolved URL is not a PDF")
-    with pdfplumber.open(io.BytesIO(r.content)) as pdf:
-        text = "\n".join(p.extract_text() or "" for p in pdf.pages)
-
-    pat = re.compile(
-        rf"Palestinians[^\d{NBSP}]{{0,40}}([\d,{NBSP}\s]+)[^\w]{{0,20}}fatalities",
-        re.I | re.S,
-    )
-    m = pat.search(text)
-    if not m:
+    pdf_path = download_pdf(pdf_url)
+    try:
+        deaths = _find_deaths(_page_texts_pdfium(pdf_path))
+    except pdfium.PdfiumError:
+        deaths = None
+    if deaths is None:   # PDFium で読めない／見つからない場合は pdfminer で再試行
+        deaths = _find_deaths(_page_texts_pdfminer(pdf_path))
+    if deaths is None:
         raise ValueError("fatalities number not found in PDF")
-    return int(re.sub(r"[^\d]", "", m.group(1)))
+    return deaths
 
 # ------------- 4) CSV を更新 --------------------------------------------------
-def update_csv(date: datetime.date, deaths: int) -> pd.DataFrame:
+def load_csv() -> pd.DataFrame:
     if os.path.exists(DATA_CSV):
-        df = pd.read_csv(DATA_CSV, parse_dates=["date"])
-    else:
-        df = pd.DataFrame(columns=["date", "fatalities"])
-    if (df["date"] == pd.Timestamp(date)).any():
-        return df
-    df = pd.concat([df, pd.DataFrame([{"date": date, "fatalities": deaths}])])
-    df = df.sort_values("date").reset_index(drop=True)
-    df.to_csv(DATA_CSV, index=False)
-    return df
+        return pd.read_csv(DATA_CSV, parse_dates=["date"])
+    return pd.DataFrame(columns=["date", "fatalities"])
+
+def update_csv(df: pd.DataFrame, date: datetime.date, deaths: int) -> tuple[pd.DataFrame, bool]:
+    """CSV に 1 行追記し、(全データ, 追加したかどうか) を返す"""
+    ts = pd.Timestamp(date)
+    if (df["date"] == ts).any():
+        return df, False
+    # snapshot は日付順に届くので、その場で末尾に足せば並びは保たれる
+    df.loc[len(df), ["date", "fatalities"]] = [ts, deaths]
+    # 行追加で float64 に変わるので整数に戻す（CSV に "100.0" と書かれないように）
+    df["fatalities"] = df["fatalities"].astype("int64")
+    if not df["date"].is_monotonic_increasing:
+        # 古い snapshot が後から届いた場合のみ並べ替えて書き直す
+        df = df.sort_values("date").reset_index(drop=True)
+        df.to_csv(DATA_CSV, index=False)
+        return df, True
+    new_file = not os.path.exists(DATA_CSV) or os.path.getsize(DATA_CSV) == 0
+    needs_newline = False
+    if not new_file:
+        # 手で編集されて末尾の改行が無い場合、追記行が最終行にくっつかないようにする
+        with open(DATA_CSV, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) not in (b"\n", b"\r")
+    with open(DATA_CSV, "a", newline="", encoding="utf-8") as f:
+        if new_file:
+            f.write("date,fatalities\n")
+        elif needs_newline:
+            f.write("\n")
+        f.write(f"{date.isoformat()},{deaths}\n")
+    return df, True
 
 # ------------- 5) グラフ作成 --------------------------------------------------
 def make_plots(df: pd.DataFrame):
-    df = df.set_index("date")
-    weekly = df["fatalities"].diff().fillna(df["fatalities"]).astype(int)
-
-    plt.figure(figsize=(8, 4))
-    plt.bar(weekly.index, weekly.values)
-    plt.title("Weekly increase in Palestinian fatalities (Gaza)")
-    plt.ylabel("Deaths / week")
-    plt.tight_layout()
-    plt.savefig(PNG_WEEKLY, dpi=150)
-    plt.close()
-
-    plt.figure(figsize=(8, 4))
-    plt.plot(df.index, df["fatalities"], marker="o")
-    plt.title("Cumulative Palestinian fatalities (Gaza)")
-    plt.ylabel("Deaths (cumulative)")
-    plt.grid(True, linestyle="--", alpha=0.4)
-    plt.tight_layout()
-    plt.savefig(PNG_CUM, dpi=150)
-    plt.close()
+    dates = df["date"].to_numpy()
+    vals  = df["fatalities"].to_numpy(dtype=np.int64)
+    # 週次増分（先頭は累計そのもの）。diff/fillna/astype の中間 Series を作らない
+    weekly = np.empty_like(vals)
+    weekly[:1] = vals[:1]
+    np.subtract(vals[1:], vals[:-1], out=weekly[1:])
+
+    # 1 枚の Figure を使い回して 2 つのグラフを描く
+    fig, ax = plt.subplots(figsize=(8, 4))
+    ax.bar(dates, weekly)
+    ax.set_title("Weekly increase in Palestinian fatalities (Gaza)")
+    ax.set_ylabel("Deaths / week")
+    fig.savefig(PNG_WEEKLY, dpi=150, bbox_inches="tight")
+
+    ax.clear()
+    ax.plot(dates, vals, marker="o")
+    ax.set_title("Cumulative Palestinian fatalities (Gaza)")
+    ax.set_ylabel("Deaths (cumulative)")
+    ax.grid(True, linestyle="--", alpha=0.4)
+    fig.savefig(PNG_CUM, dpi=150, bbox_inches="tight")
+    plt.close(fig)
 
 # ------------- 6) HTML レポート ------------------------------------------------
 HTML_TEMPLATE = """<!doctype html><meta charset="utf-8">
@@ -140,11 +284,59 @@ def write_html(df: pd.DataFrame):
         f.write(html)
 
 # ------------- main ----------------------------------------------------------
-if __name__ == "__main__":
+def outputs_stale() -> bool:
+    """グラフ／HTML が存在しないか、CSV より古ければ True"""
+    outputs = (PNG_WEEKLY, PNG_CUM, HTML_FILE)
+    if not os.path.exists(DATA_CSV) or not all(os.path.exists(p) for p in outputs):
+        return True
+    csv_mtime = os.path.getmtime(DATA_CSV)
+    return any(os.path.getmtime(p) < csv_mtime for p in outputs)
+
+def load_state() -> dict:
+    """snapshot ページ URL ごとの抽出結果（data/.state.json）を読む。読めなければ空扱い"""
+    try:
+        with open(STATE_JSON, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):   # 未作成・空・手で壊した場合
+        return {}
+    return state if isinstance(state, dict) else {}
+
+def save_state(state: dict):
+    _write_json_atomic(STATE_JSON, state, indent=2, sort_keys=True)
+
+def _skip_unchanged(df: pd.DataFrame, snap_date):
+    # 取り込み済みの snapshot なら PDF の取得・解析は不要
+    if outputs_stale():
+        make_plots(df)
+        write_html(df)
+    print(f"–  {snap_date}  already in CSV   (CSV rows: {len(df)})")
+
+def main():
+    df = load_csv()
+    # 同じ週に新しい snapshot が出ることもあるので、一覧ページは毎回確認する
     snap_date, page_url = find_latest_snapshot_page()
-    pdf_url = resolve_pdf_url(page_url)
-    deaths  = extract_deaths(pdf_url)
-    df      = update_csv(snap_date, deaths)
-    make_plots(df)
-    write_html(df)
+    known = df["date"] == pd.Timestamp(snap_date)
+    if known.any():
+        _skip_unchanged(df, snap_date)
+        return
+
+    # 前回の実行が抽出後に失敗していれば、PDF の解決・解析をやり直さない
+    state = load_state()
+    entry = state.get(page_url)
+    if (isinstance(entry, dict) and entry.get("date") == snap_date.isoformat()
+            and entry.get("url") and isinstance(entry.get("deaths"), int)):
+        pdf_url, deaths = entry["url"], int(entry["deaths"])
+    else:
+        pdf_url = resolve_pdf_url(page_url)
+        deaths  = extract_deaths(pdf_url)
+        state[page_url] = {"url": pdf_url, "date": snap_date.isoformat(), "deaths": deaths}
+        save_state(state)
+    df, appended = update_csv(df, snap_date, deaths)
+    # 新しい行が無ければ同一の PNG / HTML を作り直さない
+    if appended or outputs_stale():
+        make_plots(df)
+        write_html(df)
     print(f"✔  {snap_date}  {deaths:,} deaths   (CSV rows: {len(df)})")
+
+if __name__ == "__main__":
+    main()